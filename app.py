@@ -3,22 +3,161 @@
 使用 Flask + PostgreSQL
 """
 
-from flask import Flask, request, jsonify, send_from_directory, session, redirect
+from flask import Flask, Response, request, jsonify, send_from_directory, session, redirect
+from flask.json.provider import JSONProvider
 from flask_cors import CORS
-from werkzeug.security import generate_password_hash, check_password_hash
-from functools import wraps
+from flask_compress import Compress
+from werkzeug.middleware.proxy_fix import ProxyFix
+from werkzeug.security import check_password_hash
+from argon2 import PasswordHasher
+from argon2.exceptions import InvalidHashError, VerificationError
+from cachetools import TTLCache
+import click
 import psycopg2
 import psycopg2.extras
+from psycopg2 import pool
+import orjson
+import atexit
+import hashlib
+import itertools
+import logging
+import logging.handlers
 import os
+import queue
+import re
 import sys
-from datetime import datetime
+import threading
+from datetime import datetime, timedelta
 from urllib.parse import urlparse
 
+# 錯誤紀錄先放進佇列，由背景執行緒寫到 stderr，請求執行緒不會卡在 I/O 上
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+logger.propagate = False
+_log_queue = queue.SimpleQueue()
+logger.addHandler(logging.handlers.QueueHandler(_log_queue))
+_log_listener = None
+
+def _start_log_listener():
+    """啟動寫出紀錄的背景執行緒（fork 出來的 worker 不會繼承執行緒，需各自啟動）"""
+    global _log_listener
+    handler = logging.StreamHandler(sys.stderr)
+    handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
+    _log_listener = logging.handlers.QueueListener(_log_queue, handler)
+    _log_listener.start()
+
+def _stop_log_listener():
+    """結束前把佇列中剩下的紀錄寫完"""
+    if _log_listener is not None:
+        _log_listener.stop()
+
+_start_log_listener()
+os.register_at_fork(after_in_child=_start_log_listener)
+atexit.register(_stop_log_listener)
+
+class ORJSONProvider(JSONProvider):
+    """使用 orjson 序列化 JSON，date / datetime 直接輸出 ISO-8601 字串"""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        """jsonify() 直接使用 orjson 輸出的 UTF-8 bytes，省去轉成 str 再編碼回 bytes"""
+        # 參數處理與 jsonify() 相同：不使用 Flask 內部的 _prepare_response_obj
+        if args and kwargs:
+            raise TypeError("jsonify() 不能同時使用位置參數與關鍵字參數")
+        if not args and not kwargs:
+            obj = None
+        elif not args:
+            obj = kwargs
+        elif len(args) == 1:
+            obj = args[0]
+        else:
+            obj = args
+        return self._app.response_class(orjson.dumps(obj), mimetype='application/json')
+
 app = Flask(__name__, static_folder='static')
-app.secret_key = os.environ.get('SECRET_KEY', 'your-secret-key-change-in-production')
+app.json = ORJSONProvider(app)
+# session cookie 以 SECRET_KEY 簽章，不提供預設值，避免使用公開的弱金鑰
+SECRET_KEY = os.environ.get('SECRET_KEY')
+if not SECRET_KEY:
+    raise RuntimeError("SECRET_KEY 環境變數未設定")
+app.secret_key = SECRET_KEY
+app.config.update(
+    SESSION_COOKIE_HTTPONLY=True,
+    # 以純 HTTP（非 localhost）測試時可設定 SESSION_COOKIE_SECURE=0
+    SESSION_COOKIE_SECURE=os.environ.get('SESSION_COOKIE_SECURE', '1') == '1',
+    SESSION_COOKIE_SAMESITE='Lax',
+    # 登入後維持一週，避免管理員頻繁重新登入（每次登入都要計算耗時的密碼雜湊）
+    PERMANENT_SESSION_LIFETIME=timedelta(days=7),
+    # 正式環境的靜態檔由 nginx 送出；沒有 nginx 時（開發、PaaS）讓瀏覽器快取一小時
+    SEND_FILE_MAX_AGE_DEFAULT=3600
+)
+
+# 有設定 REDIS_URL 時把 session 存在 Redis：cookie 只帶 session id，
+# 不必每次請求都序列化、簽章整個 session，多台伺服器也能共用登入狀態
+REDIS_URL = os.environ.get('REDIS_URL')
+_redis = None
+if REDIS_URL:
+    import redis
+    from flask_session import Session
+
+    _redis = redis.from_url(REDIS_URL)
+    app.config.update(
+        SESSION_TYPE='redis',
+        SESSION_REDIS=_redis,
+        SESSION_KEY_PREFIX='product-verification:session:'
+    )
+    Session(app)
 CORS(app, supports_credentials=True)
 
+# 前面有幾層可信任的反向代理（nginx、PaaS 的負載平衡器）。設定後才採用它們加上的
+# X-Forwarded-For 作為 remote_addr；未設定時 X-Forwarded-For 一律忽略，避免用戶端偽造來源位址
+TRUSTED_PROXIES = int(os.environ.get('TRUSTED_PROXIES', 0))
+if TRUSTED_PROXIES:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXIES)
+
+# JSON 與 HTML 回應依 Accept-Encoding 壓縮（產品列表含大量重複的欄位名稱與中文，壓縮效果明顯）
+# 一般回應可用 zstd / br / gzip / deflate；串流回應（產品列表、send_from_directory）
+# 只會用 zstd / br / deflate，不會用 gzip
+app.config.update(
+    COMPRESS_MIMETYPES=['application/json', 'text/html'],
+    COMPRESS_LEVEL=5,
+    # send_from_directory 的回應是串流，壓縮後 ETag 會加上編碼後綴（例如 ":br"），
+    # 頁面路由需在這裡登記，讓 Flask-Compress 以新的 ETag 重新判斷 If-None-Match 並回 304
+    COMPRESS_STREAMING_ENDPOINT_CONDITIONAL=['static', 'index', 'login_page', 'admin']
+)
+Compress(app)
+
 DATABASE_URL = os.environ.get('DATABASE_URL', '')
+# 選填：唯讀副本的連線字串。設定後後台產品列表改走副本，不和後台寫入搶主資料庫的連線。
+# 副本會有複寫延遲，因此會寫進快取的查詢（前台驗證、統計、管理員帳號）一律讀主資料庫，
+# 避免異動後清掉的快取又被副本上的舊資料填回去（例如已刪除的編碼繼續驗證成功）
+DATABASE_READ_URL = os.environ.get('DATABASE_READ_URL', '')
+
+# 連線池大小：DB_POOL_MAX 建議不小於 gunicorn 每個 worker 的執行緒數
+# psycopg2 的連線池只會保留 minconn 條閒置連線，其餘歸還時會直接關閉
+DB_POOL_MIN = int(os.environ.get('DB_POOL_MIN', 4))
+DB_POOL_MAX = int(os.environ.get('DB_POOL_MAX', 10))
+
+# 驗證結果快取：同一產品編碼在 TTL 內直接回傳，不查資料庫
+# 每個 worker 各自一份，後台異動時只清除當前 worker 的快取，其他 worker 最多延遲 TTL 秒
+VERIFY_CACHE_TTL = int(os.environ.get('VERIFY_CACHE_TTL', 300))
+_verify_cache = TTLCache(maxsize=10000, ttl=VERIFY_CACHE_TTL)
+_verify_lock = threading.RLock()
+
+# 統計資料快取：後台儀表板重複載入時不必每次都掃描整張表
+STATS_CACHE_TTL = int(os.environ.get('STATS_CACHE_TTL', 30))
+_stats_cache = TTLCache(maxsize=1, ttl=STATS_CACHE_TTL)
+_stats_lock = threading.Lock()
+
+# 後台列表總數快取：以搜尋關鍵字為 key，翻頁時不必每次重新計算符合的筆數
+LIST_TOTAL_CACHE_TTL = int(os.environ.get('LIST_TOTAL_CACHE_TTL', 10))
+_list_total_cache = TTLCache(maxsize=1000, ttl=LIST_TOTAL_CACHE_TTL)
+_list_total_lock = threading.Lock()
 
 # 啟動時印出連線資訊（隱藏密碼）
 if DATABASE_URL:
@@ -27,20 +166,174 @@ if DATABASE_URL:
 else:
     print("警告: DATABASE_URL 環境變數未設定！")
 
-def get_db():
-    """取得資料庫連線"""
+# 常用語句以 server-side prepared statement 執行，省去每次的 parse / plan
+_PREPARED_STATEMENTS = {
+    'stmt_verify': '''
+        SELECT product_code, product_name, hospital_name, purchase_date, updated_at
+        FROM products
+        WHERE product_code = $1
+    ''',
+    'stmt_insert_product': '''
+        INSERT INTO products (product_code, product_name, hospital_name, purchase_date)
+        VALUES ($1, $2, $3, $4)
+        RETURNING id
+    ''',
+    'stmt_delete_product': 'DELETE FROM products WHERE id = $1 RETURNING product_code',
+}
+
+# 後台可修改的欄位；每種欄位組合（共 16 種）的 UPDATE 在載入時就產生並登記為 prepared statement，
+# update_product 依送來的欄位挑選，不必每次組合 SQL 字串
+UPDATABLE_FIELDS = ('product_code', 'product_name', 'hospital_name', 'purchase_date')
+
+def _build_update_statement(fields):
+    """產生只更新指定欄位的 UPDATE（參數依序為各欄位的值、產品 id）"""
+    assignments = [f'{field} = ${i}' for i, field in enumerate(fields, 1)]
+    assignments.append('updated_at = CURRENT_TIMESTAMP')
+    return f"UPDATE products SET {', '.join(assignments)} WHERE id = ${len(fields) + 1} RETURNING id"
+
+_UPDATE_STATEMENTS = {}
+for _n in range(len(UPDATABLE_FIELDS) + 1):
+    for _fields in itertools.combinations(UPDATABLE_FIELDS, _n):
+        _name = f'stmt_update_{len(_UPDATE_STATEMENTS)}'
+        _PREPARED_STATEMENTS[_name] = _build_update_statement(_fields)
+        _UPDATE_STATEMENTS[frozenset(_fields)] = _name
+
+class PreparedConnection(psycopg2.extensions.connection):
+    """記錄這條連線已經 PREPARE 過哪些語句，以及所屬的連線池"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+        self.pool = None
+
+def execute_prepared(cursor, name, params):
+    """執行 prepared statement（每條連線第一次用到時才 PREPARE）"""
+    conn = cursor.connection
+    if name not in conn.prepared:
+        cursor.execute(f'PREPARE {name} AS {_PREPARED_STATEMENTS[name]}')
+        conn.prepared.add(name)
+    placeholders = ', '.join(['%s'] * len(params))
+    cursor.execute(f'EXECUTE {name} ({placeholders})', params)
+
+# 'write' 連線池連到 DATABASE_URL；有設定 DATABASE_READ_URL 時另建 'read' 連線池
+_db_pools = {}
+_db_pool_lock = threading.Lock()
+
+def _get_pool(readonly=False):
+    """取得連線池（第一次使用時才建立，避免 gunicorn preload 時在 master 開啟連線）"""
+    name = 'read' if readonly and DATABASE_READ_URL else 'write'
+    db_pool = _db_pools.get(name)
+    if db_pool is None:
+        with _db_pool_lock:
+            db_pool = _db_pools.get(name)
+            if db_pool is None:
+                extra = {}
+                if name == 'read':
+                    # 唯讀連線，誤用在寫入時會直接報錯
+                    extra['options'] = '-c default_transaction_read_only=on'
+                db_pool = _db_pools[name] = pool.ThreadedConnectionPool(
+                    minconn=DB_POOL_MIN,
+                    maxconn=DB_POOL_MAX,
+                    dsn=DATABASE_READ_URL if name == 'read' else DATABASE_URL,
+                    sslmode='require',
+                    connection_factory=PreparedConnection,
+                    connect_timeout=10,
+                    # 閒置的連線定期送 TCP keepalive，避免被雲端負載平衡器悄悄切斷，
+                    # 連線池就能一直沿用已建立（含 SSL 握手）的連線
+                    keepalives=1,
+                    keepalives_idle=60,
+                    keepalives_interval=10,
+                    keepalives_count=5,
+                    **extra
+                )
+    return db_pool
+
+def get_db(readonly=False):
+    """從連線池取得資料庫連線，用完必須呼叫 release_db() 歸還
+    readonly=True 只用於查詢；有設定 DATABASE_READ_URL 時會連到唯讀副本"""
     if not DATABASE_URL:
         raise RuntimeError("DATABASE_URL 環境變數未設定")
     try:
-        conn = psycopg2.connect(DATABASE_URL, sslmode='require')
-        return conn
-    except Exception as e:
-        print(f"[DB ERROR] 連線失敗: {type(e).__name__}: {e}", file=sys.stderr, flush=True)
+        db_pool = _get_pool(readonly)
+        conn = db_pool.getconn()
+    except Exception:
+        logger.exception("[DB ERROR] 連線失敗")
         raise
+    conn.pool = db_pool
+    return conn
+
+def release_db(conn):
+    """歸還連線到原本的連線池（未結束的交易會自動 rollback）"""
+    conn.pool.putconn(conn)
+
+def close_db_pool():
+    """關閉所有連線池中的連線"""
+    with _db_pool_lock:
+        for db_pool in _db_pools.values():
+            db_pool.closeall()
+        _db_pools.clear()
+
+atexit.register(close_db_pool)
+
+def clear_product_caches():
+    """清除驗證結果與統計資料快取（修改產品後呼叫）"""
+    with _verify_lock:
+        _verify_cache.clear()
+    clear_stats_cache()
+
+def clear_stats_cache():
+    """清除統計資料與列表總數快取（新增產品後呼叫：查無資料的驗證結果不會快取，新增不影響驗證快取）"""
+    with _stats_lock:
+        _stats_cache.clear()
+    with _list_total_lock:
+        _list_total_cache.clear()
+
+def invalidate_product(product_code):
+    """只移除單一編碼的驗證快取與統計快取（刪除產品後呼叫），其他熱門編碼的快取保留"""
+    with _verify_lock:
+        _verify_cache.pop(product_code, None)
+    clear_stats_cache()
+
+# 產品編碼格式：英數字與連字號。前台驗證不符合格式的編碼直接回覆查無資料，不查資料庫；
+# 新增與修改也用同一規則，確保存進去的編碼都查得到
+PRODUCT_CODE_PATTERN = os.environ.get('PRODUCT_CODE_PATTERN', r'[A-Z0-9-]{4,32}')
+_CODE_RE = re.compile(PRODUCT_CODE_PATTERN)
+
+def _is_valid_code(code):
+    """檢查（已正規化的）產品編碼是否符合格式"""
+    return _CODE_RE.fullmatch(code) is not None
+
+def _normalize_code(code):
+    """產品編碼一律去除前後空白並轉大寫後再存取，
+    資料庫的 product_code 只存大寫，直接用唯一索引比對，不必在 SQL 裡呼叫 UPPER()"""
+    return code.strip().upper()
 
 def init_db():
     """初始化資料庫"""
     conn = get_db()
+    try:
+        _create_schema(conn)
+        _check_stored_codes(conn)
+    finally:
+        release_db(conn)
+    print("資料庫初始化完成")
+
+def _check_stored_codes(conn):
+    """既有編碼不符合 PRODUCT_CODE_PATTERN 時中止初始化（這些編碼在前台會查無資料）"""
+    cursor = conn.cursor(name='check_codes')
+    cursor.itersize = 5000
+    cursor.execute('SELECT product_code FROM products')
+    invalid = [code for (code,) in cursor if not _is_valid_code(code)]
+    cursor.close()
+    conn.rollback()
+    if invalid:
+        examples = '、'.join(invalid[:10])
+        raise RuntimeError(
+            f"有 {len(invalid)} 筆既有產品編碼不符合 PRODUCT_CODE_PATTERN ({PRODUCT_CODE_PATTERN})，"
+            f"前台驗證會回覆查無資料，請修正編碼或調整 PRODUCT_CODE_PATTERN。例如: {examples}")
+
+def _create_schema(conn):
+    """建立資料表、索引與預設管理員"""
     cursor = conn.cursor()
 
     # 建立產品資料表
@@ -56,9 +349,102 @@ def init_db():
         )
     ''')
 
-    # 建立索引以加速查詢
+    # 產品編碼一律以大寫儲存，查詢時直接比對欄位即可使用 UNIQUE 索引
+    # （舊資料先轉成大寫，再加上 CHECK 限制）
+    cursor.execute('''
+        UPDATE products SET product_code = UPPER(product_code)
+        WHERE product_code <> UPPER(product_code)
+    ''')
+    cursor.execute('''
+        DO $$
+        BEGIN
+            IF NOT EXISTS (
+                SELECT 1 FROM pg_constraint WHERE conname = 'products_product_code_upper'
+            ) THEN
+                ALTER TABLE products ADD CONSTRAINT products_product_code_upper
+                    CHECK (product_code = UPPER(product_code));
+            END IF;
+        END $$
+    ''')
+
+    # UNIQUE 限制已自帶索引，移除重複的舊索引
+    cursor.execute('DROP INDEX IF EXISTS idx_product_code')
+
+    # 後台搜尋欄位：編碼、名稱、醫院合併後轉小寫存成 generated column，
+    # 搭配 pg_trgm 的 GIN 索引，LIKE '%關鍵字%' 不必全表掃描
+    cursor.execute('''
+        ALTER TABLE products ADD COLUMN IF NOT EXISTS search_blob TEXT
+        GENERATED ALWAYS AS (lower(product_code || ' ' || product_name || ' ' || hospital_name)) STORED
+    ''')
+    cursor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    cursor.execute('DROP INDEX IF EXISTS idx_products_search_trgm')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_products_search_blob ON products
+        USING gin (search_blob gin_trgm_ops)
+    ''')
+
+    # 後台列表依 (created_at DESC, id DESC) 排序與 keyset 分頁，
+    # 有這個索引就能直接從索引依序讀取，不必每次排序整張表
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_products_created_id ON products (created_at DESC, id DESC)
+    ''')
+
+    # 每家醫院的產品數，由 products 的 statement-level trigger 維護，
+    # 統計資料只要讀這張小表（資料列數 = 醫院數）
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS hospital_counts (
+            hospital_name TEXT PRIMARY KEY,
+            product_count BIGINT NOT NULL
+        )
+    ''')
+    cursor.execute('''
+        CREATE OR REPLACE FUNCTION products_update_hospital_counts() RETURNS trigger
+        LANGUAGE plpgsql AS $$
+        BEGIN
+            IF TG_OP IN ('DELETE', 'UPDATE') THEN
+                UPDATE hospital_counts h
+                SET product_count = h.product_count - o.n
+                FROM (SELECT hospital_name, COUNT(*) AS n FROM old_rows GROUP BY hospital_name) o
+                WHERE h.hospital_name = o.hospital_name;
+                DELETE FROM hospital_counts
+                WHERE product_count <= 0
+                  AND hospital_name IN (SELECT hospital_name FROM old_rows);
+            END IF;
+            IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                INSERT INTO hospital_counts (hospital_name, product_count)
+                SELECT hospital_name, COUNT(*) FROM new_rows
+                GROUP BY hospital_name
+                ORDER BY hospital_name
+                ON CONFLICT (hospital_name)
+                DO UPDATE SET product_count = hospital_counts.product_count + EXCLUDED.product_count;
+            END IF;
+            RETURN NULL;
+        END $$
+    ''')
+    cursor.execute('DROP TRIGGER IF EXISTS trg_products_counts_insert ON products')
+    cursor.execute('DROP TRIGGER IF EXISTS trg_products_counts_update ON products')
+    cursor.execute('DROP TRIGGER IF EXISTS trg_products_counts_delete ON products')
+    cursor.execute('''
+        CREATE TRIGGER trg_products_counts_insert AFTER INSERT ON products
+        REFERENCING NEW TABLE AS new_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION products_update_hospital_counts()
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER trg_products_counts_update AFTER UPDATE ON products
+        REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION products_update_hospital_counts()
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER trg_products_counts_delete AFTER DELETE ON products
+        REFERENCING OLD TABLE AS old_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION products_update_hospital_counts()
+    ''')
+    # 每次初始化都依 products 重新計算一次；鎖住寫入，避免重算期間的異動被漏掉
+    cursor.execute('LOCK TABLE products IN SHARE ROW EXCLUSIVE MODE')
+    cursor.execute('DELETE FROM hospital_counts')
     cursor.execute('''
-        CREATE INDEX IF NOT EXISTS idx_product_code ON products(product_code)
+        INSERT INTO hospital_counts (hospital_name, product_count)
+        SELECT hospital_name, COUNT(*) FROM products GROUP BY hospital_name
     ''')
 
     # 建立管理員資料表
@@ -72,50 +458,153 @@ def init_db():
     ''')
 
     # 建立預設管理員帳號（如果不存在）
-    cursor.execute('SELECT COUNT(*) FROM admins')
-    if cursor.fetchone()[0] == 0:
+    # 密碼雜湊很耗時，確定需要新增時才計算；ON CONFLICT 讓同時執行也不會重複建立
+    cursor.execute('SELECT 1 FROM admins LIMIT 1')
+    if cursor.fetchone() is None:
         default_password = os.environ.get('ADMIN_PASSWORD', 'admin123')
-        password_hash = generate_password_hash(default_password)
+        password_hash = _password_hasher.hash(default_password)
         cursor.execute(
-            'INSERT INTO admins (username, password_hash) VALUES (%s, %s)',
+            'INSERT INTO admins (username, password_hash) VALUES (%s, %s) ON CONFLICT (username) DO NOTHING',
             ('admin', password_hash)
         )
-        print(f"已建立預設管理員帳號: admin")
+        if cursor.rowcount:
+            print(f"已建立預設管理員帳號: admin")
 
     conn.commit()
-    conn.close()
-    print("資料庫初始化完成")
+
+@app.cli.command('init-db')
+def init_db_command():
+    """建立資料表與預設管理員（部署時執行一次：flask --app app init-db）"""
+    try:
+        init_db()
+    except RuntimeError as e:
+        # 以非 0 結束碼中止，讓部署流程停在這一步
+        raise click.ClickException(str(e))
 
 
 # ==================== 認證相關 ====================
 
-def login_required(f):
-    """需要登入的裝飾器"""
-    @wraps(f)
-    def decorated_function(*args, **kwargs):
-        if 'admin_id' not in session:
-            return jsonify({'success': False, 'message': '請先登入'}), 401
-        return f(*args, **kwargs)
-    return decorated_function
+# 管理員帳號快取：username -> (id, password_hash)
+# 管理員通常只有一兩位，登入時直接比對快取即可，不必每次查資料庫
+# 直接在資料庫修改密碼或刪除帳號時，各 worker 最多延遲 ADMIN_CACHE_TTL 秒才會生效
+ADMIN_CACHE_TTL = int(os.environ.get('ADMIN_CACHE_TTL', 60))
+_admin_cache = TTLCache(maxsize=100, ttl=ADMIN_CACHE_TTL)
+_admin_lock = threading.Lock()
+
+def _get_admin(username):
+    """取得管理員的 (id, password_hash)，不存在時回傳 None"""
+    with _admin_lock:
+        admin = _admin_cache.get(username)
+    if admin is None:
+        conn = get_db()
+        try:
+            cursor = conn.cursor()
+            cursor.execute('SELECT id, password_hash FROM admins WHERE username = %s', (username,))
+            admin = cursor.fetchone()
+        finally:
+            release_db(conn)
+        # 只快取存在的帳號，避免隨意嘗試的帳號名稱塞滿快取
+        if admin is not None:
+            with _admin_lock:
+                _admin_cache[username] = admin
+    return admin
+
+# 密碼雜湊使用 argon2id（OWASP 建議參數），比 werkzeug 預設的 60 萬次 PBKDF2 省 CPU
+_password_hasher = PasswordHasher(time_cost=2, memory_cost=19456, parallelism=1)
+
+def _check_admin_password(username, admin, password):
+    """驗證管理員密碼；舊的 werkzeug 雜湊驗證成功後改存 argon2id"""
+    admin_id, password_hash = admin
+    if password_hash.startswith('$argon2'):
+        try:
+            _password_hasher.verify(password_hash, password)
+        except (VerificationError, InvalidHashError):
+            return False
+        if not _password_hasher.check_needs_rehash(password_hash):
+            return True
+    elif not check_password_hash(password_hash, password):
+        return False
+
+    new_hash = _password_hasher.hash(password)
+    conn = get_db()
+    try:
+        cursor = conn.cursor()
+        cursor.execute('UPDATE admins SET password_hash = %s WHERE id = %s', (new_hash, admin_id))
+        conn.commit()
+    finally:
+        release_db(conn)
+    with _admin_lock:
+        _admin_cache[username] = (admin_id, new_hash)
+    return True
+
+# 登入失敗次數限制：同一來源失敗太多次就暫停登入，避免大量嘗試耗盡 CPU 在密碼雜湊上
+# 有設定 REDIS_URL 時計數存在 Redis，所有 worker 共用；否則每個 worker 各自計數，
+# 實際上限為 LOGIN_MAX_FAILURES × worker 數
+LOGIN_MAX_FAILURES = int(os.environ.get('LOGIN_MAX_FAILURES', 5))
+LOGIN_LOCKOUT_SECONDS = int(os.environ.get('LOGIN_LOCKOUT_SECONDS', 300))
+_login_failures = TTLCache(maxsize=10000, ttl=LOGIN_LOCKOUT_SECONDS)
+_login_failures_lock = threading.Lock()
+
+def _reserve_login_attempt(client_key):
+    """先記一次失敗再驗證密碼，回傳是否允許這次嘗試
+    檢查與累加在同一步完成，同時湧入的請求不會在任何失敗被記錄前一起通過"""
+    if _redis is not None:
+        key = f'product-verification:login-failures:{client_key}'
+        pipe = _redis.pipeline()
+        # 第一次失敗時建立帶有效期限的計數，INCR 不會改變有效期限
+        pipe.set(key, 0, ex=LOGIN_LOCKOUT_SECONDS, nx=True)
+        pipe.incr(key)
+        _, attempts = pipe.execute()
+        return attempts <= LOGIN_MAX_FAILURES
+    with _login_failures_lock:
+        failures = _login_failures.get(client_key, 0)
+        if failures >= LOGIN_MAX_FAILURES:
+            return False
+        _login_failures[client_key] = failures + 1
+        return True
+
+def _clear_login_failures(client_key):
+    """登入成功後清除失敗次數"""
+    if _redis is not None:
+        _redis.delete(f'product-verification:login-failures:{client_key}')
+        return
+    with _login_failures_lock:
+        _login_failures.pop(client_key, None)
+
+# 需要登入的 API 路徑，統一在 before_request 檢查，新增的後台路由不會忘記保護
+PROTECTED_PREFIXES = ('/api/products', '/api/stats')
+
+@app.before_request
+def require_login():
+    """未登入時直接拒絕後台 API，不會進到路由取得資料庫連線
+    （CORS preflight 的 OPTIONS 不帶 cookie，交給 flask-cors 回應）"""
+    if request.method == 'OPTIONS':
+        return None
+    if request.path.startswith(PROTECTED_PREFIXES) and 'admin_id' not in session:
+        return jsonify({'success': False, 'message': '請先登入'}), 401
 
 # ==================== 前台 API ====================
 
+# HTML 頁面每次都向伺服器確認（ETag / Last-Modified），沒有變動時回 304；
+# 不像圖片等靜態檔快取一小時，部署新版後使用者馬上就會拿到新頁面
+HTML_MAX_AGE = 0
+
 @app.route('/')
 def index():
     """前台查詢頁面"""
-    return send_from_directory('static', 'index.html')
+    return send_from_directory('static', 'index.html', max_age=HTML_MAX_AGE)
 
 @app.route('/login')
 def login_page():
     """登入頁面"""
-    return send_from_directory('static', 'login.html')
+    return send_from_directory('static', 'login.html', max_age=HTML_MAX_AGE)
 
 @app.route('/admin')
 def admin():
     """後台管理頁面（需登入）"""
     if 'admin_id' not in session:
         return redirect('/login')
-    return send_from_directory('static', 'admin.html')
+    return send_from_directory('static', 'admin.html', max_age=HTML_MAX_AGE)
 
 @app.route('/api/login', methods=['POST'])
 def api_login():
@@ -127,14 +616,17 @@ def api_login():
     if not username or not password:
         return jsonify({'success': False, 'message': '請輸入帳號和密碼'}), 400
 
-    conn = get_db()
-    cursor = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-    cursor.execute('SELECT id, password_hash FROM admins WHERE username = %s', (username,))
-    admin = cursor.fetchone()
-    conn.close()
+    # 來源位址：有設定 TRUSTED_PROXIES 時由 ProxyFix 取自可信任代理加入的 X-Forwarded-For
+    client_key = request.remote_addr
+    if not _reserve_login_attempt(client_key):
+        return jsonify({'success': False, 'message': '登入失敗次數過多，請稍後再試'}), 429
 
-    if admin and check_password_hash(admin['password_hash'], password):
-        session['admin_id'] = admin['id']
+    admin = _get_admin(username)
+
+    if admin and _check_admin_password(username, admin, password):
+        _clear_login_failures(client_key)
+        session.permanent = True
+        session['admin_id'] = admin[0]
         session['admin_username'] = username
         return jsonify({'success': True, 'message': '登入成功'})
     else:
@@ -146,6 +638,13 @@ def api_logout():
     session.clear()
     return jsonify({'success': True, 'message': '已登出'})
 
+@app.route('/api/auth', methods=['GET'])
+def auth_status():
+    """nginx auth_request 用的登入檢查：已登入回 204，未登入回 401（不回傳內容）"""
+    if 'admin_id' in session:
+        return '', 204
+    return '', 401
+
 @app.route('/api/check-auth', methods=['GET'])
 def check_auth():
     """檢查登入狀態"""
@@ -162,105 +661,215 @@ def verify_product(product_code):
     驗證產品編碼
     GET /api/verify/{product_code}
     """
-    conn = get_db()
-    cursor = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+    key = _normalize_code(product_code)
+    if not _is_valid_code(key):
+        return jsonify({
+            'success': True,
+            'verified': False,
+            'message': '查無此產品編碼，請確認編碼是否正確'
+        })
 
-    cursor.execute('''
-        SELECT product_code, product_name, hospital_name, purchase_date
-        FROM products
-        WHERE UPPER(product_code) = UPPER(%s)
-    ''', (product_code,))
+    with _verify_lock:
+        cached = _verify_cache.get(key)
+
+    if cached is None:
+        # 結果會快取並帶 Cache-Control: public，必須讀主資料庫
+        conn = get_db()
+        try:
+            cursor = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
 
-    product = cursor.fetchone()
-    conn.close()
+            execute_prepared(cursor, 'stmt_verify', (key,))
 
-    if product:
-        purchase_date = product['purchase_date']
-        if hasattr(purchase_date, 'isoformat'):
-            purchase_date = purchase_date.isoformat()
-        return jsonify({
+            product = cursor.fetchone()
+        finally:
+            release_db(conn)
+
+        if not product:
+            return jsonify({
+                'success': True,
+                'verified': False,
+                'message': '查無此產品編碼，請確認編碼是否正確'
+            })
+
+        result = {
             'success': True,
             'verified': True,
             'data': {
                 'product_code': product['product_code'],
                 'product_name': product['product_name'],
                 'hospital_name': product['hospital_name'],
-                'purchase_date': purchase_date
+                'purchase_date': product['purchase_date']
             }
-        })
-    else:
-        return jsonify({
-            'success': True,
-            'verified': False,
-            'message': '查無此產品編碼，請確認編碼是否正確'
-        })
+        }
+        # 產品資料修改時 updated_at 會變，ETag 也跟著改變
+        etag = hashlib.blake2b(
+            f"{product['product_code']}|{product['updated_at']}".encode(),
+            digest_size=16
+        ).hexdigest()
+        cached = (result, etag)
+        # 只快取查詢成功的結果，新增產品後不會被「查無此編碼」的快取擋住
+        with _verify_lock:
+            _verify_cache[key] = cached
+
+    result, etag = cached
+    # 驗證結果可讓瀏覽器與 CDN 快取；重複掃描時以 If-None-Match 回傳 304
+    response = jsonify(result)
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = VERIFY_CACHE_TTL
+    return response.make_conditional(request)
 
 # ==================== 後台 API ====================
 
+# 後台列表回傳的欄位（不含內部使用的 search_blob）
+PRODUCT_FIELDS = ('id', 'product_code', 'product_name', 'hospital_name', 'purchase_date', 'created_at', 'updated_at')
+PRODUCT_COLUMNS = ', '.join(PRODUCT_FIELDS)
+
+def _encode_page_cursor(row):
+    """以最後一筆的 (created_at, id) 產生下一頁的 cursor"""
+    return f"{row['created_at'].isoformat()},{row['id']}"
+
+def _decode_page_cursor(value):
+    """解析 cursor，格式錯誤時拋出 ValueError"""
+    created_at, _, product_id = value.rpartition(',')
+    return datetime.fromisoformat(created_at), int(product_id)
+
+def _parse_date(value):
+    """解析購買日期（接受 2024-01-05、2024/1/5），格式錯誤時拋出 ValueError"""
+    return datetime.strptime(value.strip().replace('/', '-'), '%Y-%m-%d').date()
+
+# 每頁筆數上限（後台匯出一次取 1000 筆）
+MAX_PER_PAGE = 1000
+
 @app.route('/api/products', methods=['GET'])
-@login_required
 def get_all_products():
     """
     取得所有產品（支援分頁）
-    GET /api/products?page=1&per_page=20&search=關鍵字
+    GET /api/products?page=1&per_page=20&search=關鍵字&with_total=1
+    GET /api/products?cursor=<上一頁的 next_cursor>&per_page=20  （keyset 分頁）
+    總數只在帶 with_total=1 時計算；是否還有下一頁看 pagination.has_more
     """
     page = request.args.get('page', 1, type=int)
     per_page = request.args.get('per_page', 20, type=int)
-    search = request.args.get('search', '', type=str)
-    
-    conn = get_db()
-    cursor = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+    search = request.args.get('search', '', type=str).strip()
+    page_cursor = request.args.get('cursor', '', type=str)
+    with_total = request.args.get('with_total', 0, type=int) == 1
+
+    if page < 1 or not 1 <= per_page <= MAX_PER_PAGE:
+        return jsonify({
+            'success': False,
+            'message': f'page 需大於 0，per_page 需介於 1 到 {MAX_PER_PAGE}'
+        }), 400
 
-    offset = (page - 1) * per_page
+    conditions = []
+    params = []
 
     if search:
-        # 搜尋產品編碼、名稱或醫院
-        search_pattern = f'%{search}%'
-        cursor.execute('''
-            SELECT COUNT(*) FROM products
-            WHERE product_code ILIKE %s OR product_name ILIKE %s OR hospital_name ILIKE %s
-        ''', (search_pattern, search_pattern, search_pattern))
-        total = cursor.fetchone()['count']
-
-        cursor.execute('''
-            SELECT * FROM products
-            WHERE product_code ILIKE %s OR product_name ILIKE %s OR hospital_name ILIKE %s
-            ORDER BY created_at DESC
-            LIMIT %s OFFSET %s
-        ''', (search_pattern, search_pattern, search_pattern, per_page, offset))
+        # 搜尋產品編碼、名稱或醫院（search_blob 已轉小寫，關鍵字也用 lower() 轉換）
+        # 跳脫 LIKE 的萬用字元，關鍵字中的 % 或 _ 只比對字面，trigram 索引也才能有效篩選
+        conditions.append('search_blob LIKE lower(%s)')
+        escaped = search.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        params.append(f'%{escaped}%')
+
+    # 總數只受搜尋條件影響，不含 keyset 的位置條件
+    count_where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+    count_params = list(params)
+
+    if page_cursor:
+        # keyset 分頁：直接從上一頁最後一筆之後開始，成本與頁數深度無關
+        try:
+            after_created, after_id = _decode_page_cursor(page_cursor)
+        except ValueError:
+            return jsonify({
+                'success': False,
+                'message': 'cursor 格式錯誤'
+            }), 400
+        conditions.append('(created_at, id) < (%s, %s)')
+        params.extend([after_created, after_id])
+        offset = 0
     else:
-        cursor.execute('SELECT COUNT(*) FROM products')
-        total = cursor.fetchone()['count']
+        offset = (page - 1) * per_page
+
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+
+    total = None
+    if with_total:
+        with _list_total_lock:
+            total = _list_total_cache.get(search)
+
+    conn = get_db(readonly=True)
+    try:
+        if with_total and total is None:
+            count_cursor = conn.cursor()
+            count_cursor.execute(f'SELECT COUNT(*) FROM products {count_where}', count_params)
+            total = count_cursor.fetchone()[0]
+            with _list_total_lock:
+                _list_total_cache[search] = total
 
-        cursor.execute('''
-            SELECT * FROM products
-            ORDER BY created_at DESC
+        # server-side cursor：資料分批從資料庫取回並直接串流輸出，不必整頁放在記憶體
+        # 使用預設的 tuple 資料列，輸出時才依 PRODUCT_FIELDS 組成 dict
+        cursor = conn.cursor(name='products_page')
+        cursor.itersize = 500
+
+        # 多取一筆判斷是否還有下一頁，不必計算總數
+        cursor.execute(f'''
+            SELECT {PRODUCT_COLUMNS} FROM products
+            {where}
+            ORDER BY created_at DESC, id DESC
             LIMIT %s OFFSET %s
-        ''', (per_page, offset))
-
-    rows = cursor.fetchall()
-    products = []
-    for row in rows:
-        product = dict(row)
-        for key in ('purchase_date', 'created_at', 'updated_at'):
-            if key in product and hasattr(product[key], 'isoformat'):
-                product[key] = product[key].isoformat()
-        products.append(product)
-    conn.close()
-    
-    return jsonify({
-        'success': True,
-        'data': products,
-        'pagination': {
-            'page': page,
+        ''', params + [per_page + 1, offset])
+        # 先取回第一批資料再開始串流：查詢失敗多半在這一步發生，
+        # 此時還能回傳完整的 500 JSON 錯誤，而不是送出一半的 200 回應
+        first_rows = cursor.fetchmany(min(cursor.itersize, per_page + 1))
+    except Exception as e:
+        release_db(conn)
+        logger.exception("[DB ERROR] 取得產品列表失敗")
+        return jsonify({
+            'success': False,
+            'message': f'取得產品列表失敗: {str(e)}'
+        }), 500
+
+    def generate():
+        yield b'{"success":true,"data":['
+        count = 0
+        last_row = None
+        has_more = False
+        try:
+            for values in itertools.chain(first_rows, cursor):
+                if count == per_page:
+                    has_more = True
+                    break
+                row = dict(zip(PRODUCT_FIELDS, values))
+                yield (b',' if count else b'') + orjson.dumps(row)
+                count += 1
+                last_row = row
+        except Exception:
+            # 狀態碼已經送出，只能記錄錯誤並中斷回應，客戶端會收到不完整的 JSON
+            logger.exception("[DB ERROR] 產品列表串流中斷")
+            raise
+
+        pagination = {
             'per_page': per_page,
-            'total': total,
-            'total_pages': (total + per_page - 1) // per_page
+            'has_more': has_more,
+            'next_cursor': _encode_page_cursor(last_row) if has_more else None
         }
-    })
+        if not page_cursor:
+            pagination['page'] = page
+        if total is not None:
+            pagination.update({
+                'total': total,
+                'total_pages': (total + per_page - 1) // per_page
+            })
+        yield b'],"pagination":' + orjson.dumps(pagination) + b'}'
+
+    response = Response(generate(), mimetype='application/json')
+    # 回應送完（或連線中斷）時才歸還連線
+    response.call_on_close(lambda: release_db(conn))
+    if total is not None:
+        response.headers['X-Total-Count'] = str(total)
+    return response
 
 @app.route('/api/products', methods=['POST'])
-@login_required
 def add_product():
     """
     新增產品
@@ -268,7 +877,7 @@ def add_product():
     Body: { product_code, product_name, hospital_name, purchase_date }
     """
     data = request.get_json()
-    
+
     required_fields = ['product_code', 'product_name', 'hospital_name', 'purchase_date']
     for field in required_fields:
         if not data.get(field):
@@ -276,24 +885,34 @@ def add_product():
                 'success': False,
                 'message': f'缺少必要欄位: {field}'
             }), 400
-    
-    conn = get_db()
-    cursor = conn.cursor()
 
+    product_code = _normalize_code(data['product_code'])
+    if not _is_valid_code(product_code):
+        return jsonify({
+            'success': False,
+            'message': '產品編碼格式錯誤'
+        }), 400
+
+    try:
+        purchase_date = _parse_date(data['purchase_date'])
+    except ValueError:
+        return jsonify({
+            'success': False,
+            'message': '購買日期格式錯誤，請使用 YYYY-MM-DD'
+        }), 400
+
+    conn = get_db()
     try:
-        cursor.execute('''
-            INSERT INTO products (product_code, product_name, hospital_name, purchase_date)
-            VALUES (%s, %s, %s, %s)
-            RETURNING id
-        ''', (
-            data['product_code'].upper(),
+        cursor = conn.cursor()
+        execute_prepared(cursor, 'stmt_insert_product', (
+            product_code,
             data['product_name'],
             data['hospital_name'],
-            data['purchase_date'].replace('/', '-')
+            purchase_date
         ))
         product_id = cursor.fetchone()[0]
         conn.commit()
-        conn.close()
+        clear_stats_cache()
 
         return jsonify({
             'success': True,
@@ -303,110 +922,126 @@ def add_product():
 
     except psycopg2.IntegrityError:
         conn.rollback()
-        conn.close()
         return jsonify({
             'success': False,
             'message': '產品編碼已存在'
         }), 409
+    finally:
+        release_db(conn)
 
 @app.route('/api/products/<int:product_id>', methods=['PUT'])
-@login_required
 def update_product(product_id):
     """
     更新產品
     PUT /api/products/{id}
     """
     data = request.get_json()
-    
-    conn = get_db()
-    cursor = conn.cursor()
-
-    # 檢查產品是否存在
-    cursor.execute('SELECT id FROM products WHERE id = %s', (product_id,))
-    if not cursor.fetchone():
-        conn.close()
-        return jsonify({
-            'success': False,
-            'message': '找不到該產品'
-        }), 404
-
-    # 檢查新編碼是否與其他產品重複
-    if data.get('product_code'):
-        cursor.execute('''
-            SELECT id FROM products
-            WHERE UPPER(product_code) = UPPER(%s) AND id != %s
-        ''', (data['product_code'], product_id))
-        if cursor.fetchone():
-            conn.close()
-            return jsonify({
-                'success': False,
-                'message': '產品編碼已被其他產品使用'
-            }), 409
 
-    # 更新資料
+    # 更新資料（欄位順序與 UPDATABLE_FIELDS 相同）
     update_fields = []
     update_values = []
 
+    product_code = None
     if data.get('product_code'):
-        update_fields.append('product_code = %s')
-        update_values.append(data['product_code'].upper())
+        product_code = _normalize_code(data['product_code'])
+        update_fields.append('product_code')
+        update_values.append(product_code)
     if data.get('product_name'):
-        update_fields.append('product_name = %s')
+        update_fields.append('product_name')
         update_values.append(data['product_name'])
     if data.get('hospital_name'):
-        update_fields.append('hospital_name = %s')
+        update_fields.append('hospital_name')
         update_values.append(data['hospital_name'])
     if data.get('purchase_date'):
-        update_fields.append('purchase_date = %s')
-        update_values.append(data['purchase_date'])
+        try:
+            purchase_date = _parse_date(data['purchase_date'])
+        except ValueError:
+            return jsonify({
+                'success': False,
+                'message': '購買日期格式錯誤，請使用 YYYY-MM-DD'
+            }), 400
+        update_fields.append('purchase_date')
+        update_values.append(purchase_date)
 
-    update_fields.append('updated_at = %s')
-    update_values.append(datetime.now().isoformat())
     update_values.append(product_id)
 
-    cursor.execute(f'''
-        UPDATE products
-        SET {', '.join(update_fields)}
-        WHERE id = %s
-    ''', update_values)
+    conn = get_db()
+    try:
+        cursor = conn.cursor()
+        if product_code is not None and not _is_valid_code(product_code):
+            # 舊資料的編碼可能不符合目前的格式：編碼沒有變動時照常更新其他欄位，
+            # 只有改成新的編碼時才要求符合格式
+            cursor.execute('SELECT product_code FROM products WHERE id = %s', (product_id,))
+            row = cursor.fetchone()
+            if row is None:
+                return jsonify({
+                    'success': False,
+                    'message': '找不到該產品'
+                }), 404
+            if row[0] != product_code:
+                return jsonify({
+                    'success': False,
+                    'message': '產品編碼格式錯誤'
+                }), 400
+
+        execute_prepared(cursor, _UPDATE_STATEMENTS[frozenset(update_fields)], update_values)
+
+        # 編碼重複由 UNIQUE 限制擋下（IntegrityError），沒有回傳資料列就是產品不存在
+        if cursor.fetchone() is None:
+            return jsonify({
+                'success': False,
+                'message': '找不到該產品'
+            }), 404
+
+        conn.commit()
+        clear_product_caches()
+
+    except psycopg2.IntegrityError:
+        conn.rollback()
+        return jsonify({
+            'success': False,
+            'message': '產品編碼已被其他產品使用'
+        }), 409
+    finally:
+        release_db(conn)
 
-    conn.commit()
-    conn.close()
-    
     return jsonify({
         'success': True,
         'message': '產品更新成功'
     })
 
 @app.route('/api/products/<int:product_id>', methods=['DELETE'])
-@login_required
 def delete_product(product_id):
     """
     刪除產品
     DELETE /api/products/{id}
     """
     conn = get_db()
-    cursor = conn.cursor()
+    try:
+        cursor = conn.cursor()
 
-    cursor.execute('SELECT id FROM products WHERE id = %s', (product_id,))
-    if not cursor.fetchone():
-        conn.close()
-        return jsonify({
-            'success': False,
-            'message': '找不到該產品'
-        }), 404
+        execute_prepared(cursor, 'stmt_delete_product', (product_id,))
+        row = cursor.fetchone()
+        if not row:
+            return jsonify({
+                'success': False,
+                'message': '找不到該產品'
+            }), 404
+
+        conn.commit()
+        invalidate_product(row[0])
+    finally:
+        release_db(conn)
 
-    cursor.execute('DELETE FROM products WHERE id = %s', (product_id,))
-    conn.commit()
-    conn.close()
-    
     return jsonify({
         'success': True,
         'message': '產品刪除成功'
     })
 
+# 批次新增回報的重複編碼數量上限，避免整份重複的檔案產生過大的回應
+MAX_REPORTED_DUPLICATES = 50
+
 @app.route('/api/products/batch', methods=['POST'])
-@login_required
 def batch_add_products():
     """
     批次新增產品
@@ -422,22 +1057,36 @@ def batch_add_products():
             'message': '沒有提供產品資料'
         }), 400
 
-    # 先在 Python 端驗證資料，減少無效的資料庫請求
-    valid_products = []
+    # 先在 Python 端驗證資料並去除同批次重複的編碼（後出現的覆蓋先出現的），
+    # 減少送到資料庫的資料量
+    rows_by_code = {}
+    valid_count = 0
     errors = []
     for i, product in enumerate(products):
         try:
-            code = product.get('product_code', '').strip()
+            code = _normalize_code(product.get('product_code', ''))
             name = product.get('product_name', '').strip()
             hospital = product.get('hospital_name', '').strip()
-            date = product.get('purchase_date', '').strip().replace('/', '-')
-            if not code or not name or not hospital or not date:
-                continue
-            valid_products.append((code.upper(), name, hospital, date))
+            date = product.get('purchase_date', '').strip()
         except Exception as e:
             errors.append(f"第 {i+1} 筆: {str(e)}")
+            continue
+        if not code or not name or not hospital or not date:
+            errors.append(f"第 {i+1} 筆: 缺少必要欄位")
+            continue
+        if not _is_valid_code(code):
+            errors.append(f"第 {i+1} 筆: 產品編碼格式錯誤")
+            continue
+        # 在這裡先轉成 date，資料庫不必逐筆解析文字，格式錯誤也不會送出
+        try:
+            date = _parse_date(date)
+        except ValueError:
+            errors.append(f"第 {i+1} 筆: 購買日期格式錯誤")
+            continue
+        rows_by_code[code] = (code, name, hospital, date)
+        valid_count += 1
 
-    if not valid_products:
+    if not rows_by_code:
         return jsonify({
             'success': False,
             'message': '沒有有效的產品資料',
@@ -445,84 +1094,99 @@ def batch_add_products():
         }), 400
 
     conn = get_db()
-    cursor = conn.cursor()
-    success_count = 0
-    duplicate_count = 0
-
     try:
-        # 使用 ON CONFLICT 一次批次插入，跳過重複的編碼
-        psycopg2.extras.execute_values(
-            cursor,
-            '''INSERT INTO products (product_code, product_name, hospital_name, purchase_date)
-               VALUES %s
-               ON CONFLICT (product_code) DO NOTHING''',
-            valid_products,
-            page_size=500
-        )
-        success_count = cursor.rowcount
-        duplicate_count = len(valid_products) - success_count
-        conn.commit()
-
-        if duplicate_count > 0:
-            errors.append(f"{duplicate_count} 筆編碼已存在，已略過")
-
+        # 整批在同一個交易內完成：成功時 commit，發生例外時自動 rollback
+        with conn:
+            cursor = conn.cursor()
+            # 使用 ON CONFLICT 一次批次插入，跳過已存在的編碼；
+            # RETURNING 回傳實際新增的編碼（rowcount 只會反映最後一頁），
+            # 與送出的編碼相減就是被略過的重複編碼，不必逐筆捕捉 IntegrityError
+            inserted = psycopg2.extras.execute_values(
+                cursor,
+                '''INSERT INTO products (product_code, product_name, hospital_name, purchase_date)
+                   VALUES %s
+                   ON CONFLICT (product_code) DO NOTHING
+                   RETURNING product_code''',
+                list(rows_by_code.values()),
+                page_size=1000,
+                fetch=True
+            )
     except Exception as e:
-        print(f"[BATCH ERROR] 批次新增失敗: {type(e).__name__}: {e}", file=sys.stderr, flush=True)
-        conn.rollback()
-        conn.close()
+        logger.exception("[BATCH ERROR] 批次新增失敗")
         return jsonify({
             'success': False,
             'message': f'批次新增失敗: {str(e)}'
         }), 500
     finally:
-        conn.close()
+        release_db(conn)
+
+    clear_stats_cache()
+    success_count = len(inserted)
+    # 同一份檔案內重複的編碼只保留最後一筆，其餘不算「已存在」
+    in_batch_duplicate_count = valid_count - len(rows_by_code)
+    existing_count = len(rows_by_code) - success_count
+    duplicate_count = in_batch_duplicate_count + existing_count
+    if in_batch_duplicate_count > 0:
+        errors.append(f"{in_batch_duplicate_count} 筆編碼在檔案中重複，只保留最後一筆")
+    if existing_count > 0:
+        errors.append(f"{existing_count} 筆編碼已存在，已略過")
+    # 資料庫中已存在而被略過的編碼另外回傳，不混進 errors 的筆數
+    skipped_codes = sorted(rows_by_code.keys() - {row[0] for row in inserted})
 
     return jsonify({
         'success': True,
         'message': f'成功新增 {success_count} 筆，略過 {duplicate_count} 筆重複',
         'success_count': success_count,
-        'errors': errors
+        'errors': errors,
+        'skipped_codes': skipped_codes[:MAX_REPORTED_DUPLICATES]
     })
 
 @app.route('/api/stats', methods=['GET'])
-@login_required
 def get_stats():
     """取得統計資料"""
-    conn = get_db()
-    cursor = conn.cursor()
-    
-    cursor.execute('SELECT COUNT(*) FROM products')
-    total = cursor.fetchone()[0]
-    
-    cursor.execute('''
-        SELECT COUNT(DISTINCT hospital_name) FROM products
-    ''')
-    hospital_count = cursor.fetchone()[0]
-    
-    conn.close()
-    
-    return jsonify({
-        'success': True,
-        'data': {
+    with _stats_lock:
+        stats = _stats_cache.get('stats')
+    if stats is None:
+        conn = get_db()
+        try:
+            cursor = conn.cursor()
+            # 由 trigger 維護的 hospital_counts 只有每家醫院一列，不必掃描 products
+            cursor.execute('''
+                SELECT COALESCE(SUM(product_count), 0)::bigint, COUNT(*) FROM hospital_counts
+            ''')
+            total, hospital_count = cursor.fetchone()
+        finally:
+            release_db(conn)
+
+        stats = {
             'total_products': total,
             'total_hospitals': hospital_count
         }
+        with _stats_lock:
+            _stats_cache['stats'] = stats
+
+    return jsonify({
+        'success': True,
+        'data': stats
     })
 
-# 確保 static 資料夾存在
-os.makedirs('static', exist_ok=True)
+if __name__ == '__main__':
+    # 本機開發用；正式環境請使用 gunicorn -c gunicorn.conf.py app:app
+    # 確保 static 資料夾存在
+    os.makedirs('static', exist_ok=True)
 
-# 初始化資料庫（部署時也會執行）
-try:
-    init_db()
-except Exception as e:
-    print(f"資料庫初始化失敗: {e}")
-    print(f"DATABASE_URL 是否設定: {'是' if DATABASE_URL else '否'}")
-    raise
+    # 初始化資料庫（正式環境在部署時執行 flask --app app init-db）
+    try:
+        init_db()
+    except Exception as e:
+        print(f"資料庫初始化失敗: {e}")
+        print(f"DATABASE_URL 是否設定: {'是' if DATABASE_URL else '否'}")
+        raise
 
-if __name__ == '__main__':
-    # 啟動伺服器
+    # 啟動伺服器（除錯模式的 reloader 與 debugger 會拖慢每個請求，需要時才以 FLASK_DEBUG=1 開啟）
+    port = int(os.environ.get('PORT', 5000))
+    debug = os.environ.get('FLASK_DEBUG') == '1'
     print("伺服器啟動中...")
-    print("前台查詢頁面: http://localhost:5000")
-    print("後台管理頁面: http://localhost:5000/admin")
-    app.run(host='0.0.0.0', port=5000, debug=True)
+    print(f"前台查詢頁面: http://localhost:{port}")
+    print(f"後台管理頁面: http://localhost:{port}/admin")
+    app.run(host='0.0.0.0', port=port, debug=debug, threaded=True)
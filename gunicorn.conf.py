@@ -0,0 +1,18 @@
+"""
+Gunicorn 設定檔
+gthread worker：每個 worker 以多執行緒處理請求，讓資料庫 I/O 可以重疊
+"""
+
+import os
+
+# PaaS 需要對外監聽；VPS 前面有 nginx 時設定 BIND_HOST=127.0.0.1，只讓 nginx 連進來
+bind = f"{os.environ.get('BIND_HOST', '0.0.0.0')}:{os.environ.get('PORT', '5000')}"
+worker_class = 'gthread'
+workers = int(os.environ.get('WEB_CONCURRENCY', 3))
+threads = int(os.environ.get('GUNICORN_THREADS', 8))
+timeout = 120
+keepalive = 5
+
+# 在 master 載入 app 後再 fork，worker 共用已載入的程式碼
+preload_app = True
+